@@ -2,9 +2,14 @@ import os
 import time
 import json
 import logging
+import queue
+import signal
+import threading
+import uuid
 import boto3
+import zstandard as zstd
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
-from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -13,55 +18,213 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 AWS_REGION = os.getenv("AWS_REGION", "us-west-1")
+# Upper bound on in-flight S3 uploads. Used both as the worker count and as
+# botocore's max_pool_connections (urllib3's pool_maxsize, default 10), so every
+# concurrent upload gets a pooled connection instead of a fresh TCP+TLS handshake.
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "32"))
+# SQS returns at most 10 messages per receive and deletes at most 10 per batch
+BATCH_SIZE = 10
+# How long the delete worker waits to fill a DeleteMessageBatch
+DELETE_FLUSH_INTERVAL = 1.0
+
+# Per-call time limits. A call's worst case is MAX_ATTEMPTS tries of connect + read
+# plus standard-mode retry backoff (at most 1s + 2s between the three tries).
+MAX_ATTEMPTS = 3
+CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 10
+SQS_READ_TIMEOUT = 25  # must exceed the 20s long-poll wait
+RETRY_BACKOFF = 3
+UPLOAD_TIMEOUT = MAX_ATTEMPTS * (CONNECT_TIMEOUT + S3_READ_TIMEOUT) + RETRY_BACKOFF
+DELETE_TIMEOUT = MAX_ATTEMPTS * (CONNECT_TIMEOUT + SQS_READ_TIMEOUT) + RETRY_BACKOFF
+
+# Most messages received but not yet uploaded (queued or in flight). The poller only
+# calls receive_message once a full batch fits, and with the default MAX_CONCURRENCY
+# every received message goes straight to a free worker instead of waiting in a queue.
+PREFETCH_LIMIT = max(MAX_CONCURRENCY, BATCH_SIZE)
+# Received messages must stay invisible until they are uploaded and deleted, or SQS
+# redelivers them (a duplicate upload) and the delete uses a stale receipt handle.
+# Worst case: waiting for ceil(PREFETCH_LIMIT / MAX_CONCURRENCY) - 1 earlier uploads
+# on the same worker, its own upload, the delete flush and one delete call. This
+# assumes the single delete worker isn't stuck behind an earlier stalled delete.
+# Failed messages are retried only after this timeout (about 2.5 minutes by default).
+VISIBILITY_TIMEOUT = (
+    -(-PREFETCH_LIMIT // MAX_CONCURRENCY) * UPLOAD_TIMEOUT
+    + int(DELETE_FLUSH_INTERVAL) + DELETE_TIMEOUT
+)
 
 if not SQS_QUEUE_URL or not S3_BUCKET_NAME:
     logging.error("Missing required environment variables: SQS_QUEUE_URL or S3_BUCKET_NAME")
     exit(1)
 
-# Initialize AWS clients
-sqs = boto3.client("sqs", region_name=AWS_REGION)
-s3 = boto3.client("s3", region_name=AWS_REGION)
+# Initialize AWS clients. TCP keepalive stops idle pooled connections from being
+# dropped during the 20s long-poll wait, which would cost a new handshake.
+# Request parameters are fixed shapes built here, so botocore's per-call
+# validation against the service model is skipped.
+BOTO_CONFIG = Config(
+    region_name=AWS_REGION,
+    retries={"max_attempts": MAX_ATTEMPTS, "mode": "standard"},
+    connect_timeout=CONNECT_TIMEOUT,
+    tcp_keepalive=True,
+    max_pool_connections=MAX_CONCURRENCY,
+    parameter_validation=False
+)
+sqs = boto3.client("sqs", config=BOTO_CONFIG.merge(Config(read_timeout=SQS_READ_TIMEOUT)))
+s3 = boto3.client("s3", config=BOTO_CONFIG.merge(Config(read_timeout=S3_READ_TIMEOUT)))
+
+# Bound once for the per-message parse. Not orjson: it rejects NaN/Infinity, which the
+# Producer's stdlib encoder forwards, so those messages would be redelivered forever
+_LOADS = json.loads
+
+# ZstdCompressor instances can't be shared between threads, so each upload worker gets its own
+_ZSTD = threading.local()
 
-def process_message(message_body: dict) -> None:
-    """Uploads message body to S3 with a timestamp-based key."""
-    timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S-%fZ")
-    s3_key = f"messages/message-{timestamp}.json"
+def _compress(body: bytes) -> bytes:
+    """Compresses an S3 object body with zstd level 3 using this thread's compressor."""
+    cctx = getattr(_ZSTD, "cctx", None)
+    if cctx is None:
+        cctx = _ZSTD.cctx = zstd.ZstdCompressor(level=3)
+    return cctx.compress(body)
+
+def _build_s3_key() -> str:
+    """Builds a UTC timestamp-based S3 key with a random suffix to avoid collisions."""
+    sec, us = divmod(time.time_ns() // 1000, 1_000_000)
+    t = time.gmtime(sec)
+    return (
+        f"messages/message-{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+        f"T{t.tm_hour:02d}-{t.tm_min:02d}-{t.tm_sec:02d}-{us:06d}Z-{uuid.uuid4().hex[:8]}.json.zst"
+    )
+
+def process_message(message_body: str) -> None:
+    """Uploads the raw JSON message body to S3, zstd-compressed, with a timestamp-based key."""
+    s3_key = _build_s3_key()
     try:
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=s3_key, Body=json.dumps(message_body))
-        logging.info(f"Uploaded message to S3 at {s3_key}")
+        s3.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=s3_key,
+            Body=_compress(message_body.encode("utf-8")),
+            ContentType="application/json",
+            ContentEncoding="zstd"
+        )
+        logging.info("Uploaded message to S3 at %s", s3_key)
     except (BotoCoreError, ClientError) as e:
-        logging.error(f"Failed to upload message to S3: {e}")
+        logging.error("Failed to upload message to S3: %s", e)
         raise
 
-def poll_queue():
-    """Polls the SQS queue every 15 seconds and processes messages."""
-    logging.info("Starting Microservice 2 polling loop...")
+def _handle_one(msg: dict):
+    """Processes a single SQS message and returns its receipt handle on success."""
+    try:
+        # Only validate the JSON; the original bytes are stored as-is
+        _LOADS(msg["Body"])
+        process_message(msg["Body"])
+        return msg["ReceiptHandle"]
+    except Exception as e:
+        logging.error("Error processing message: %s", e)
+        return None
+
+def _delete_batch(receipt_handles: list) -> None:
+    """Deletes processed messages from SQS with a single DeleteMessageBatch call."""
+    entries = [{"Id": str(i), "ReceiptHandle": h} for i, h in enumerate(receipt_handles)]
+    try:
+        response = sqs.delete_message_batch(QueueUrl=SQS_QUEUE_URL, Entries=entries)
+    except (BotoCoreError, ClientError) as e:
+        logging.error("Failed to delete messages from SQS: %s", e)
+        return
+
+    failed = response.get("Failed", [])
+    for entry in failed:
+        logging.error("Failed to delete message %s from SQS: %s", entry["Id"], entry.get("Message", entry.get("Code")))
+    logging.info("Deleted %d message(s) from SQS.", len(entries) - len(failed))
+
+def _upload_worker(work_queue: queue.Queue, delete_queue: queue.Queue, slots: threading.Semaphore) -> None:
+    """Uploads messages from work_queue and queues their receipt handles for deletion until it gets None."""
     while True:
+        msg = work_queue.get()
+        if msg is None:
+            return
         try:
-            response = sqs.receive_message(
-                QueueUrl=SQS_QUEUE_URL,
-                MaxNumberOfMessages=10,
-                WaitTimeSeconds=5,
-                VisibilityTimeout=30
-            )
-
-            messages = response.get("Messages", [])
-            if not messages:
-                logging.info("No messages received. Waiting...")
-            else:
-                for msg in messages:
-                    try:
-                        body = json.loads(msg["Body"])
-                        process_message(body)
-                        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=msg["ReceiptHandle"])
-                        logging.info("Deleted message from SQS.")
-                    except Exception as e:
-                        logging.error(f"Error processing message: {e}")
-
-        except (BotoCoreError, ClientError) as e:
-            logging.error(f"Polling error: {e}")
-
-        time.sleep(15)
+            handle = _handle_one(msg)
+            if handle:
+                delete_queue.put(handle)
+        finally:
+            # Free this message's prefetch slot for the poller
+            slots.release()
+
+def _delete_worker(delete_queue: queue.Queue) -> None:
+    """Deletes receipt handles from delete_queue in batches of up to 10 until it gets None."""
+    while True:
+        batch = []
+        handle = delete_queue.get()
+        while handle is not None:
+            batch.append(handle)
+            if len(batch) == BATCH_SIZE:
+                break
+            try:
+                handle = delete_queue.get(timeout=DELETE_FLUSH_INTERVAL)
+            except queue.Empty:
+                break
+        if batch:
+            _delete_batch(batch)
+        if handle is None:
+            return
+
+def poll_queue():
+    """Long-polls the SQS queue and hands messages to upload workers as soon as they arrive."""
+    logging.info("Starting Microservice 2 polling loop...")
+    work_queue = queue.Queue()
+    delete_queue = queue.Queue()
+    # One slot per message received but not yet uploaded; see PREFETCH_LIMIT
+    slots = threading.Semaphore(PREFETCH_LIMIT)
+    uploaders = [
+        threading.Thread(target=_upload_worker, args=(work_queue, delete_queue, slots), daemon=True)
+        for _ in range(MAX_CONCURRENCY)
+    ]
+    deleter = threading.Thread(target=_delete_worker, args=(delete_queue,), daemon=True)
+    for thread in uploaders + [deleter]:
+        thread.start()
+
+    try:
+        while True:
+            # Only receive once a full batch fits, so received messages never sit waiting
+            # for room while their visibility timeout runs
+            for _ in range(BATCH_SIZE):
+                slots.acquire()
+
+            messages = []
+            try:
+                response = sqs.receive_message(
+                    QueueUrl=SQS_QUEUE_URL,
+                    MaxNumberOfMessages=BATCH_SIZE,
+                    WaitTimeSeconds=20,
+                    VisibilityTimeout=VISIBILITY_TIMEOUT
+                )
+
+                messages = response.get("Messages", [])
+                if not messages:
+                    logging.info("No messages received. Waiting...")
+
+            except (BotoCoreError, ClientError) as e:
+                logging.error("Polling error: %s", e)
+                # Back off briefly so transport errors don't turn into a hot loop
+                time.sleep(1)
+
+            # Give back the slots this batch didn't use; uploads overlap with the next receive
+            for _ in range(BATCH_SIZE - len(messages)):
+                slots.release()
+            for msg in messages:
+                work_queue.put(msg)
+    finally:
+        # Finish the messages already received and flush their deletes before exiting
+        for _ in uploaders:
+            work_queue.put(None)
+        for thread in uploaders:
+            thread.join()
+        delete_queue.put(None)
+        deleter.join()
+
+def _handle_sigterm(signum, frame):
+    """Turns the SIGTERM sent by ECS into a normal exit so poll_queue can drain its workers."""
+    raise SystemExit(0)
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     poll_queue()
\ No newline at end of file
@@ -3,7 +3,11 @@ from unittest.mock import patch, MagicMock
 import os
 import sys
 import json
-from datetime import datetime
+import queue
+import threading
+import uuid
+import zstandard as zstd
+from botocore.exceptions import ClientError
 
 # Add the 'Consumer' directory to the Python path for importing 'app'
 # This is crucial for the test file to find and import the 'app' module.
@@ -79,9 +83,11 @@ class TestConsumerApp(unittest.TestCase):
         # Ensure s3.put_object has no side effect by default (e.g., no exceptions from previous tests).
         self.mock_s3_client.put_object.side_effect = None
         # Default SQS receive_message to return no messages unless explicitly set otherwise in a test.
+        self.mock_sqs_client.receive_message.side_effect = None
         self.mock_sqs_client.receive_message.return_value = {"Messages": []}
-        # Default SQS delete_message to succeed.
-        self.mock_sqs_client.delete_message.return_value = {}
+        # Default SQS delete_message_batch to succeed.
+        self.mock_sqs_client.delete_message_batch.side_effect = None
+        self.mock_sqs_client.delete_message_batch.return_value = {"Successful": [], "Failed": []}
 
         # Patch time.sleep: This prevents actual delays during tests, making them run fast.
         # It's patched per test method as it's a standard library function.
@@ -101,24 +107,20 @@ class TestConsumerApp(unittest.TestCase):
         """
         Tests the successful processing and S3 upload of a valid message.
         Verifies that:
-        1. S3 put_object is called exactly once with the correct bucket, key format, and body.
-        2. The S3 key incorporates the correct mocked timestamp.
+        1. S3 put_object is called exactly once with the correct bucket, key, and compressed body.
+        2. The S3 key incorporates the correct mocked timestamp and random suffix.
         """
-        message_body = {
+        message_body = json.dumps({
             "email_subject": "Hello",
             "email_sender": "test@example.com",
             "email_timestamp": 1678886400,
             "email_content": "This is a test message."
-        }
-
-        # Patch app.datetime to control the current time, ensuring predictable S3 keys.
-        with patch('app.datetime') as mock_datetime:
-            mock_datetime.utcnow.return_value = datetime(2023, 3, 15, 10, 0, 0)
-            # These side_effects ensure that strftime and fromtimestamp on the mocked datetime
-            # object behave as expected, returning predictable strings/objects.
-            mock_datetime.strftime.side_effect = lambda dt, fmt: datetime(2023, 3, 15, 10, 0, 0).strftime(fmt)
-            mock_datetime.fromtimestamp.side_effect = lambda ts: datetime.fromtimestamp(ts)
+        })
 
+        # Pin the clock and the UUID so the S3 key is predictable.
+        now_ns = 1678874400_123456_000  # 2023-03-15T10:00:00.123456Z
+        with patch('app.time.time_ns', return_value=now_ns), \
+                patch('app.uuid.uuid4', return_value=uuid.UUID("0123456789abcdef0123456789abcdef")):
             # Call the function under test directly from the imported app module.
             self.app_module.process_message(message_body)
 
@@ -126,9 +128,11 @@ class TestConsumerApp(unittest.TestCase):
             self.mock_s3_client.put_object.assert_called_once()
             args, kwargs = self.mock_s3_client.put_object.call_args
             self.assertEqual(kwargs['Bucket'], self.S3_BUCKET_NAME)
-            self.assertTrue(kwargs['Key'].startswith("messages/message-"))
-            self.assertTrue(kwargs['Key'].endswith(".json"))
-            self.assertEqual(json.loads(kwargs['Body']), message_body)
+            self.assertEqual(kwargs['Key'], "messages/message-2023-03-15T10-00-00-123456Z-01234567.json.zst")
+            # The body is the original JSON, unchanged apart from zstd compression.
+            self.assertEqual(zstd.ZstdDecompressor().decompress(kwargs['Body']).decode("utf-8"), message_body)
+            self.assertEqual(kwargs['ContentType'], "application/json")
+            self.assertEqual(kwargs['ContentEncoding'], "zstd")
 
     def test_process_message_s3_failure(self):
         """
@@ -139,7 +143,7 @@ class TestConsumerApp(unittest.TestCase):
         """
         # Configure the mock s3 client's put_object method to raise an exception.
         self.mock_s3_client.put_object.side_effect = Exception("S3 upload failed")
-        message_body = {"data": "some_data"}
+        message_body = json.dumps({"data": "some_data"})
 
         # Assert that calling process_message raises the expected exception.
         with self.assertRaises(Exception) as cm:
@@ -157,26 +161,38 @@ class TestConsumerApp(unittest.TestCase):
         Verifies that:
         1. SQS receive_message is called once with correct parameters.
         2. No S3 upload or SQS message deletion occurs.
-        3. The polling loop terminates correctly (due to mocked time.sleep).
+        3. The polling loop does not sleep between polls (long polling does the waiting).
         """
-        # Configure SQS receive_message mock to return an empty list of messages.
-        self.mock_sqs_client.receive_message.return_value = {"Messages": []}
-        # Configure time.sleep to immediately raise StopIteration, causing the poll_queue loop to exit after one iteration.
-        self.mock_time_sleep.side_effect = [StopIteration]
+        # Return an empty batch once, then raise StopIteration on the next poll to exit the loop.
+        self.mock_sqs_client.receive_message.side_effect = [{"Messages": []}, StopIteration]
 
-        # Assert that poll_queue raises StopIteration (as configured by mock_time_sleep).
+        # Assert that poll_queue raises StopIteration (as configured by receive_message).
         with self.assertRaises(StopIteration):
             self.app_module.poll_queue()
 
         # Assertions for SQS and S3 interactions
-        self.mock_sqs_client.receive_message.assert_called_once_with(
+        self.assertEqual(self.mock_sqs_client.receive_message.call_count, 2)
+        self.mock_sqs_client.receive_message.assert_called_with(
             QueueUrl=self.SQS_QUEUE_URL,
             MaxNumberOfMessages=10,
-            WaitTimeSeconds=5,
-            VisibilityTimeout=30
+            WaitTimeSeconds=20,
+            VisibilityTimeout=self.app_module.VISIBILITY_TIMEOUT
         )
         self.mock_s3_client.put_object.assert_not_called()
-        self.mock_sqs_client.delete_message.assert_not_called()
+        self.mock_sqs_client.delete_message_batch.assert_not_called()
+        self.mock_time_sleep.assert_not_called()
+
+    def test_poll_queue_backs_off_on_error(self):
+        """
+        Tests that poll_queue sleeps briefly after a transport error instead of spinning.
+        """
+        error = ClientError({"Error": {"Code": "InternalError", "Message": "boom"}}, "ReceiveMessage")
+        self.mock_sqs_client.receive_message.side_effect = [error, StopIteration]
+
+        with self.assertRaises(StopIteration):
+            self.app_module.poll_queue()
+
+        self.mock_time_sleep.assert_called_once_with(1)
 
     def test_poll_queue_with_messages(self):
         """
@@ -184,38 +200,132 @@ class TestConsumerApp(unittest.TestCase):
         Verifies that:
         1. SQS receive_message is called once.
         2. process_message is called for each received message.
-        3. SQS delete_message is called for each processed message.
+        3. SQS delete_message_batch is called once for all processed messages.
+        4. The loop polls again straight away without sleeping.
         """
         # Define mock SQS messages, including their JSON body and receipt handle.
         mock_messages = [
             {"Body": json.dumps({"id": 1, "email_subject": "Msg1"}), "ReceiptHandle": "handle1"},
             {"Body": json.dumps({"id": 2, "email_subject": "Msg2"}), "ReceiptHandle": "handle2"},
         ]
-        # Configure SQS receive_message to return these mock messages.
-        self.mock_sqs_client.receive_message.return_value = {"Messages": mock_messages}
-        # Configure time.sleep to immediately raise StopIteration, exiting the loop after one message batch.
-        self.mock_time_sleep.side_effect = [StopIteration]
+        # Return the mock messages once, then raise StopIteration on the next poll to exit the loop.
+        self.mock_sqs_client.receive_message.side_effect = [{"Messages": mock_messages}, StopIteration]
 
         # Patch app.process_message to verify it's called correctly without re-testing its internal logic.
         with patch('app.process_message') as mock_process_message:
-            # Assert that poll_queue raises StopIteration (as configured by mock_time_sleep).
+            # Assert that poll_queue raises StopIteration (as configured by receive_message).
             with self.assertRaises(StopIteration):
                 self.app_module.poll_queue()
 
             # Assertions for SQS and process_message interactions
-            self.mock_sqs_client.receive_message.assert_called_once()
+            self.assertEqual(self.mock_sqs_client.receive_message.call_count, 2)
             self.assertEqual(mock_process_message.call_count, 2)  # process_message should be called twice
 
-            # Verify process_message was called with the correct parsed bodies.
-            expected_body_1 = json.loads(mock_messages[0]["Body"])
-            expected_body_2 = json.loads(mock_messages[1]["Body"])
-            mock_process_message.assert_any_call(expected_body_1)
-            mock_process_message.assert_any_call(expected_body_2)
+            # Verify process_message was called with the raw message bodies.
+            mock_process_message.assert_any_call(mock_messages[0]["Body"])
+            mock_process_message.assert_any_call(mock_messages[1]["Body"])
+
+            # Assert both processed messages were deleted with a single batch call.
+            # Upload workers finish in any order, so compare the handles as a set.
+            self.mock_sqs_client.delete_message_batch.assert_called_once()
+            kwargs = self.mock_sqs_client.delete_message_batch.call_args.kwargs
+            self.assertEqual(kwargs["QueueUrl"], self.SQS_QUEUE_URL)
+            self.assertEqual({e["ReceiptHandle"] for e in kwargs["Entries"]}, {"handle1", "handle2"})
+            self.mock_sqs_client.delete_message.assert_not_called()
+
+            # The next receive follows immediately; there is no idle sleep between batches.
+            self.mock_time_sleep.assert_not_called()
+
+    def test_poll_queue_failed_message_not_deleted(self):
+        """
+        Tests that a message whose upload fails is left out of the delete batch,
+        so it becomes visible again and is retried.
+        """
+        mock_messages = [
+            {"Body": json.dumps({"id": 1}), "ReceiptHandle": "handle1"},
+            {"Body": "not json", "ReceiptHandle": "handle2"},
+        ]
+        self.mock_sqs_client.receive_message.side_effect = [{"Messages": mock_messages}, StopIteration]
+
+        with self.assertRaises(StopIteration):
+            self.app_module.poll_queue()
+
+        self.mock_s3_client.put_object.assert_called_once()
+        self.mock_sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl=self.SQS_QUEUE_URL,
+            Entries=[{"Id": "0", "ReceiptHandle": "handle1"}]
+        )
+
+    def test_handle_one_accepts_non_finite_numbers(self):
+        """
+        Tests that bodies with NaN/Infinity, which the Producer's stdlib encoder forwards,
+        are uploaded and returned for deletion instead of being redelivered forever.
+        """
+        msg = {"Body": '{"email_timestamp":1,"x":NaN,"y":Infinity}', "ReceiptHandle": "handle1"}
+
+        self.assertEqual(self.app_module._handle_one(msg), "handle1")
+        self.mock_s3_client.put_object.assert_called_once()
+
+    def test_visibility_timeout_covers_upload_and_delete(self):
+        """
+        Tests that received messages stay invisible for at least one worst-case
+        upload plus the delete flush and one worst-case delete.
+        """
+        app = self.app_module
+        self.assertGreaterEqual(
+            app.VISIBILITY_TIMEOUT,
+            app.UPLOAD_TIMEOUT + app.DELETE_FLUSH_INTERVAL + app.DELETE_TIMEOUT
+        )
+        self.assertGreaterEqual(app.PREFETCH_LIMIT, app.BATCH_SIZE)
+
+    def test_upload_worker_releases_slot_on_failure(self):
+        """
+        Tests that an upload worker frees the message's prefetch slot even when
+        the upload fails, so the poller keeps receiving.
+        """
+        self.mock_s3_client.put_object.side_effect = Exception("S3 upload failed")
+        work_queue, delete_queue = queue.Queue(), queue.Queue()
+        slots = threading.Semaphore(0)
+        work_queue.put({"Body": json.dumps({"id": 1}), "ReceiptHandle": "handle1"})
+        work_queue.put(None)
+
+        self.app_module._upload_worker(work_queue, delete_queue, slots)
+
+        self.assertTrue(slots.acquire(blocking=False))
+        self.assertTrue(delete_queue.empty())
+
+    def test_delete_worker_batches_up_to_ten(self):
+        """
+        Tests that the delete worker groups queued receipt handles into
+        DeleteMessageBatch calls of at most 10 entries and flushes the rest on shutdown.
+        """
+        delete_queue = queue.Queue()
+        for i in range(12):
+            delete_queue.put(f"handle{i}")
+        delete_queue.put(None)
+
+        self.app_module._delete_worker(delete_queue)
+
+        calls = self.mock_sqs_client.delete_message_batch.call_args_list
+        self.assertEqual([len(c.kwargs["Entries"]) for c in calls], [10, 2])
+        self.assertEqual(calls[1].kwargs["Entries"], [
+            {"Id": "0", "ReceiptHandle": "handle10"},
+            {"Id": "1", "ReceiptHandle": "handle11"},
+        ])
+
+    def test_delete_batch_logs_failed_entries(self):
+        """
+        Tests that entries SQS reports as failed in DeleteMessageBatch are logged.
+        """
+        self.mock_sqs_client.delete_message_batch.return_value = {
+            "Successful": [{"Id": "0"}],
+            "Failed": [{"Id": "1", "SenderFault": True, "Code": "ReceiptHandleIsInvalid", "Message": "bad handle"}]
+        }
+
+        with self.assertLogs(level="ERROR") as cm:
+            self.app_module._delete_batch(["handle1", "handle2"])
 
-            # Assert SQS delete_message was called for each processed message.
-            self.assertEqual(self.mock_sqs_client.delete_message.call_count, 2)
-            self.mock_sqs_client.delete_message.assert_any_call(QueueUrl=self.SQS_QUEUE_URL, ReceiptHandle="handle1")
-            self.mock_sqs_client.delete_message.assert_any_call(QueueUrl=self.SQS_QUEUE_URL, ReceiptHandle="handle2")
+        self.assertIn("Failed to delete message 1 from SQS: bad handle", cm.output[0])
 
 
 if __name__ == '__main__':
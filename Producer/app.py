@@ -1,19 +1,80 @@
 from flask import Flask, request, jsonify
 import boto3
+from botocore.config import Config
 import os
 import json
-from datetime import datetime
-from prometheus_client import generate_latest, Counter, Histogram, Gauge
+import hmac
+import gc
+import threading
+import time
+from prometheus_client import generate_latest, CollectorRegistry, Counter, Histogram, Gauge, multiprocess
 
 app = Flask(__name__)
+# Messages are small JSON documents; anything bigger is rejected without being parsed
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
+
+AWS_REGION = os.getenv("AWS_REGION", "us-west-1")
+
+# max_pool_connections maps to urllib3's pool_maxsize (default 10); TCP keepalive
+# keeps idle pooled connections alive between requests. Parameters are fixed
+# shapes built here, so botocore's per-call validation is skipped.
+BOTO_CONFIG = Config(
+    region_name=AWS_REGION,
+    retries={"max_attempts": 3, "mode": "standard"},
+    tcp_keepalive=True,
+    max_pool_connections=32,
+    parameter_validation=False
+)
+
+# Created on first use, so under gunicorn's preload each worker builds its own
+# client (credentials, connection pool) after the fork instead of inheriting the
+# master's; it is then shared by the worker's gthread threads
+_SQS = None
+_SQS_LOCK = threading.Lock()
+
+
+def _get_sqs():
+    """Returns this process's SQS client, creating it on first use."""
+    global _SQS
+    if _SQS is None:
+        with _SQS_LOCK:
+            if _SQS is None:
+                _SQS = boto3.client("sqs", config=BOTO_CONFIG)
+    return _SQS
+
+
+def _fetch_token() -> str:
+    """Reads the auth token from SSM through a throwaway session.
+
+    The SSM service models are cached by the session's loader, so a private
+    session (rather than boto3's default one) lets them be freed afterwards.
+    """
+    client = boto3.session.Session().client("ssm", config=BOTO_CONFIG)
+    try:
+        return client.get_parameter(Name="/microservice1/token", WithDecryption=True)["Parameter"]["Value"]
+    finally:
+        client.close()
+
+
+def _load_auth_token() -> str:
+    """Returns the auth token, preferring an AUTH_TOKEN override from the environment."""
+    token = os.environ.get("AUTH_TOKEN")
+    if token:
+        return token
+    token = _fetch_token()
+    # Free the throwaway session, its client and the SSM models they loaded
+    gc.collect()
+    return token
 
-ssm = boto3.client("ssm", region_name=os.getenv("AWS_REGION", "us-west-1"))
-sqs = boto3.client("sqs", region_name=os.getenv("AWS_REGION", "us-west-1"))
 
-# Load token from SSM once on startup
-AUTH_TOKEN = ssm.get_parameter(Name="/microservice1/token", WithDecryption=True)["Parameter"]["Value"]
+# Load token once on startup (in the gunicorn master, which preloads the app)
+AUTH_TOKEN = _load_auth_token()
+AUTH_TOKEN_BYTES = AUTH_TOKEN.encode("utf-8")
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
 
+# Reused compact encoder: no per-call encoder construction, no whitespace in the SQS body
+_ENCODE = json.JSONEncoder(separators=(",", ":")).encode
+
 # --- START OF PROMETHEUS METRICS DEFINITIONS ---
 REQUEST_COUNT = Counter(
     'http_requests_total', 'Total HTTP Requests', ['method', 'endpoint']
@@ -30,42 +91,72 @@ UNAUTHORIZED_ACCESS_COUNT = Counter(
 HEALTH_STATUS = Gauge('app_health_status', 'Application Health Status (1=OK, 0=Degraded)')
 # --- END OF PROMETHEUS METRICS DEFINITIONS ---
 
+# Rendered metrics are reused for this many seconds so rapid scrapes don't
+# re-walk every collector on the request path
+METRICS_CACHE_TTL = 1.0
+# Starts at -inf so the first scrape always renders, however early it comes
+_METRICS_CACHE = [float("-inf"), b""]
+
+
+def _collect_metrics() -> bytes:
+    """Renders metrics, aggregating all gunicorn workers when multiprocess mode is enabled."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
 # --- NEW ENDPOINT FOR PROMETHEUS SCRAPING ---
 @app.route("/metrics")
 def metrics():
     """
     Exposes Prometheus metrics for scraping.
     """
-    return generate_latest(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    now = time.monotonic()
+    cached_at, body = _METRICS_CACHE
+    if now - cached_at > METRICS_CACHE_TTL:
+        body = _collect_metrics()
+        _METRICS_CACHE[:] = [now, body]
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 # --- END NEW ENDPOINT ---
 
 @app.route("/message", methods=["POST"])
 def receive_message():
     try:
-        data = request.get_json()
-        if not data or "data" not in data or "token" not in data:
+        # Reject oversized bodies before reading them
+        if request.content_length is not None and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+            return jsonify({"error": "Payload too large"}), 413
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or "token" not in data:
             return jsonify({"error": "Invalid request format"}), 400
 
+        # Validate token (constant-time comparison) before looking at the message
         token = data["token"]
-        message_data = data["data"]
-
-        # Validate token
-        if token != AUTH_TOKEN:
+        if not isinstance(token, str) or not hmac.compare_digest(token.encode("utf-8"), AUTH_TOKEN_BYTES):
+            UNAUTHORIZED_ACCESS_COUNT.inc()
             return jsonify({"error": "Unauthorized"}), 401
 
+        if "data" not in data:
+            return jsonify({"error": "Invalid request format"}), 400
+        message_data = data["data"]
+
         # Validate timestamp
         if "email_timestamp" not in message_data:
             return jsonify({"error": "Missing email_timestamp"}), 400
         try:
             timestamp = int(message_data["email_timestamp"])
-            datetime.fromtimestamp(timestamp)  # validation
-        except ValueError:
+            # Same range datetime accepts (years 1-9999), without building one
+            if not -62135596800 <= timestamp <= 253402300799:
+                raise ValueError
+        except (TypeError, ValueError, OverflowError):
             return jsonify({"error": "Invalid email_timestamp"}), 400
 
         # Send to SQS
-        sqs.send_message(
+        _get_sqs().send_message(
             QueueUrl=SQS_QUEUE_URL,
-            MessageBody=json.dumps(message_data)
+            MessageBody=_ENCODE(message_data)
         )
 
         return jsonify({"status": "Message sent to SQS"}), 200
@@ -79,5 +170,6 @@ def health_check():
     return "Microservice 1 OK", 200
 
 
+# Local development only; the container runs the app under gunicorn
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=80)
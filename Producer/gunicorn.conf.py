@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+
+# One pre-forked worker per CPU, each serving requests from a thread pool.
+# Requests spend most of their time blocked on SQS, so threads keep a worker
+# busy while the worker's boto3 SQS client (which is thread-safe) is shared
+# between them.
+bind = "0.0.0.0:80"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = 8
+# Import app.py once in the master so the SSM token is fetched a single time per
+# container and inherited by every forked worker. That fetch is the only AWS call
+# made in the master, through a throwaway session that is closed and collected
+# before the fork; the SQS client is built lazily in each worker (app._get_sqs).
+preload_app = True
+
+
+# With preload_app the metrics are also created in the master, so it writes its
+# own files to PROMETHEUS_MULTIPROC_DIR. child_exit only runs for workers, so the
+# master is never marked dead: its zero-valued counters are harmless, but its
+# series of the "all"-mode app_health_status gauge (pid label = master pid)
+# stays in every scrape for the life of the container.
+def child_exit(server, worker):
+    """Removes a dead worker's live gauge files from the Prometheus multiprocess directory."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
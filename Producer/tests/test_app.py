@@ -2,8 +2,11 @@ import unittest
 from unittest.mock import patch
 import os
 import sys
+import tempfile
 from flask import json
 from moto import mock_aws
+from prometheus_client import REGISTRY
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
 
 # Add the 'Producer' directory to the Python path for importing 'app'
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -43,13 +46,24 @@ class TestProducerApp(unittest.TestCase):
         # Assuming app.py does 'import boto3', and then 'boto3.client('ssm', ...)'.
         cls.boto3_patcher = patch('boto3.client', return_value=cls.mock_ssm_client)
         cls.boto3_patcher.start()
+        # The SSM token is fetched through a throwaway boto3 Session, so patch that too.
+        cls.session_patcher = patch('boto3.session.Session')
+        cls.session_patcher.start().return_value.client.return_value = cls.mock_ssm_client
 
         # Now, import the app. It will use the mocked boto3.client.
         # This import is done once for the class.
-        from app import app as flask_app_module, SQS_QUEUE_URL, sqs
+        import app as producer_module
+        from app import app as flask_app_module, SQS_QUEUE_URL
+        cls.producer_module = producer_module  # The app.py module itself, for its helpers
         cls.app_module = flask_app_module  # Store the imported app module
         cls.SQS_QUEUE_URL = SQS_QUEUE_URL
-        cls.sqs_client_original = sqs  # Store original SQS client for later patching
+        # The SQS client is created lazily; build it now while boto3 is still patched
+        cls.sqs_client_original = producer_module._get_sqs()  # Store original SQS client for later patching
+
+        # Set TESTING mode once and share one Flask test client across all tests;
+        # no test relies on cookies or other client state.
+        cls.app_module.config["TESTING"] = True
+        cls.client = cls.app_module.test_client()
 
         # It's good practice to stop patches started in setUpClass in tearDownClass
         # but we'll do it in setUp/tearDown for SQS client to reset per test.
@@ -58,6 +72,7 @@ class TestProducerApp(unittest.TestCase):
     def tearDownClass(cls):
         # Stop the boto3.client patcher that was started in setUpClass
         cls.boto3_patcher.stop()
+        cls.session_patcher.stop()
         # Clean up imported app module from sys.modules
         if 'app' in sys.modules:
             del sys.modules['app']
@@ -65,20 +80,13 @@ class TestProducerApp(unittest.TestCase):
 
     # setUp is run before each test method
     def setUp(self):
-        # Set TESTING mode for the Flask app instance
-        self.app = self.app_module
-        self.app.config["TESTING"] = True
-
-        # Create a new Flask test client for each test
-        self.client = self.app.test_client()
-
         # Patch SQS send_message for each test
         self.sqs_send_message_patcher = patch.object(self.sqs_client_original, 'send_message')
         self.mock_sqs_send_message = self.sqs_send_message_patcher.start()
 
     # tearDown is run after each test method to clean up patches
     def tearDown(self):
-        self.mock_sqs_send_message.stop()
+        self.sqs_send_message_patcher.stop()
 
     # --- Test Methods (remain largely the same) ---
 
@@ -88,6 +96,55 @@ class TestProducerApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data.decode("utf-8"), "Microservice 1 OK")
 
+    def test_metrics(self):
+        """Tests that the metrics endpoint exposes Prometheus metrics."""
+        with patch('app._METRICS_CACHE', [float("-inf"), b""]):
+            response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"sqs_messages_sent_total", response.data)
+
+    def test_metrics_first_scrape_renders_early(self):
+        """Tests that the first scrape renders metrics even if the monotonic clock is still below the TTL."""
+        with patch('app._METRICS_CACHE', list(self.producer_module._METRICS_CACHE)), \
+                patch('app.time.monotonic', return_value=0.5):
+            response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"sqs_messages_sent_total", response.data)
+
+    def test_metrics_multiprocess_aggregates_worker_files(self):
+        """Tests that with PROMETHEUS_MULTIPROC_DIR set, /metrics renders the workers' metric files."""
+        with tempfile.TemporaryDirectory() as multiproc_dir:
+            # What a gunicorn worker's SQS_MESSAGES_SENT.inc() would leave on disk
+            worker_file = MmapedDict(os.path.join(multiproc_dir, "counter_12345.db"))
+            worker_file.write_value(
+                mmap_key("sqs_messages_sent_total", "sqs_messages_sent_total", [], [], "Total messages sent to SQS"),
+                3.0, 0.0
+            )
+            worker_file.close()
+
+            with patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": multiproc_dir}), \
+                    patch('app._METRICS_CACHE', [float("-inf"), b""]), \
+                    patch('app.multiprocess.MultiProcessCollector',
+                          wraps=self.producer_module.multiprocess.MultiProcessCollector) as mock_collector:
+                response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        mock_collector.assert_called_once()
+        self.assertIn(b"sqs_messages_sent_total 3.0", response.data)
+        # Only the files are read; this process's own registry is not rendered
+        self.assertNotIn(b"http_requests_total", response.data)
+
+    def test_metrics_cached_within_ttl(self):
+        """Tests that repeated scrapes within the TTL reuse the rendered metrics."""
+        with patch('app._METRICS_CACHE', [float("-inf"), b""]), \
+                patch('app._collect_metrics', return_value=b"cached_metric 1.0\n") as mock_collect:
+            first = self.client.get("/metrics")
+            second = self.client.get("/metrics")
+
+        mock_collect.assert_called_once()
+        self.assertEqual(first.data, b"cached_metric 1.0\n")
+        self.assertEqual(second.data, b"cached_metric 1.0\n")
+
     def test_receive_message_success(self):
         """Tests successful message reception and SQS dispatch."""
         payload = {
@@ -105,18 +162,46 @@ class TestProducerApp(unittest.TestCase):
         self.assertEqual(response.json, {"status": "Message sent to SQS"})
         self.mock_sqs_send_message.assert_called_once_with(
             QueueUrl=self.SQS_QUEUE_URL,
-            # --- התיקון כאן: הוסף sort_keys=True ---
-            MessageBody=json.dumps(payload["data"], sort_keys=True)
+            # Flask's test client sends keys sorted; the app encodes them compactly in that order
+            MessageBody=json.dumps(payload["data"], sort_keys=True, separators=(",", ":"))
         )
         # Assert that get_parameter was called on our mock ssm client
         self.mock_ssm_client.get_parameter.assert_called_once_with(Name="/microservice1/token", WithDecryption=True)
 
+    def test_load_auth_token_prefers_environment(self):
+        """Tests that a token provided through AUTH_TOKEN is used without calling SSM."""
+        calls_before = self.mock_ssm_client.get_parameter.call_count
+        with patch.dict(os.environ, {"AUTH_TOKEN": "inherited-token"}), \
+                patch('app.gc.collect') as mock_collect:
+            token = self.producer_module._load_auth_token()
+        self.assertEqual(token, "inherited-token")
+        self.assertEqual(self.mock_ssm_client.get_parameter.call_count, calls_before)
+        # Nothing was fetched, so there is nothing for the garbage collector to free.
+        mock_collect.assert_not_called()
+
     def test_receive_message_invalid_format(self):
         """Tests handling of invalid request format."""
         response = self.client.post("/message", json={"some_other_key": "value"})
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json, {"error": "Invalid request format"})
 
+    def test_receive_message_missing_data(self):
+        """Tests handling of an authorized request without a 'data' field."""
+        response = self.client.post("/message", json={"token": "$DJ!S4K#5ke3RkY="})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Invalid request format"})
+
+    def test_receive_message_payload_too_large(self):
+        """Tests that bodies over MAX_CONTENT_LENGTH are rejected before parsing."""
+        payload = {
+            "data": {"email_timestamp": 1672531200, "email_content": "x" * (64 * 1024)},
+            "token": "$DJ!S4K#5ke3RkY="
+        }
+        response = self.client.post("/message", json=payload)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json, {"error": "Payload too large"})
+        self.mock_sqs_send_message.assert_not_called()
+
     def test_receive_message_unauthorized(self):
         """Tests handling of incorrect token."""
         payload = {
@@ -128,6 +213,23 @@ class TestProducerApp(unittest.TestCase):
             },
             "token": "INCORRECT_TOKEN_123"
         }
+        before = REGISTRY.get_sample_value("unauthorized_access_total")
+        response = self.client.post("/message", json=payload)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json, {"error": "Unauthorized"})
+        self.assertEqual(REGISTRY.get_sample_value("unauthorized_access_total"), before + 1)
+
+    def test_receive_message_non_string_token(self):
+        """Tests that a non-string token is rejected as unauthorized."""
+        payload = {
+            "data": {
+                "email_subject": "Test",
+                "email_sender": "test@example.com",
+                "email_timestamp": 1672531200,
+                "email_content": "Test content"
+            },
+            "token": 12345
+        }
         response = self.client.post("/message", json=payload)
         self.assertEqual(response.status_code, 401)
         self.assertEqual(response.json, {"error": "Unauthorized"})
@@ -161,6 +263,31 @@ class TestProducerApp(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json, {"error": "Invalid email_timestamp"})
 
+    def test_receive_message_out_of_range_timestamp(self):
+        """Tests handling of an 'email_timestamp' outside the representable date range."""
+        payload = {
+            "data": {
+                "email_subject": "Test",
+                "email_sender": "test@example.com",
+                "email_timestamp": 10 ** 12,
+                "email_content": "Test content"
+            },
+            "token": "$DJ!S4K#5ke3RkY="
+        }
+        response = self.client.post("/message", json=payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Invalid email_timestamp"})
+        self.mock_sqs_send_message.assert_not_called()
+
+    def test_receive_message_infinite_timestamp(self):
+        """Tests handling of an 'email_timestamp' that parses to infinity."""
+        # 1e400 overflows to float('inf'), which json= can't serialize, so send the raw body
+        body = '{"token": "$DJ!S4K#5ke3RkY=", "data": {"email_timestamp": 1e400}}'
+        response = self.client.post("/message", data=body, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Invalid email_timestamp"})
+        self.mock_sqs_send_message.assert_not_called()
+
     def test_receive_message_sqs_error(self):
         """Tests handling of SQS send_message error."""
         self.mock_sqs_send_message.side_effect = Exception("SQS is down!")
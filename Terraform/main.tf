@@ -138,7 +138,8 @@ resource "aws_ecs_cluster" "cluster" {
 }
 
 resource "aws_sqs_queue" "queue" {
-  name = "microservice-queue"
+  name                      = "microservice-queue"
+  receive_wait_time_seconds = 20
 
   tags = {
     Name = "microservice-queue"
@@ -193,6 +194,11 @@ resource "aws_ecs_task_definition" "microservice1" {
       {
         name  = "TOKEN_PARAM"
         value = aws_ssm_parameter.auth_token.name
+      },
+      {
+        # Fargate tasks get credentials from the ECS container endpoint; skip IMDS probes
+        name  = "AWS_EC2_METADATA_DISABLED"
+        value = "true"
       }
     ]
   }])
@@ -253,6 +259,11 @@ resource "aws_ecs_task_definition" "microservice2" {
       {
         name  = "AWS_REGION"
         value = var.region
+      },
+      {
+        # Fargate tasks get credentials from the ECS container endpoint; skip IMDS probes
+        name  = "AWS_EC2_METADATA_DISABLED"
+        value = "true"
       }
     ]
   }])